@@ -1,6 +1,10 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.nn.utils.spectral_norm import SpectralNorm
 
 
 ##################################################################################
@@ -45,8 +49,44 @@ def batch_norm(num_features, eps=1e-05, momentum=0.1):
     return nn.BatchNorm2d(num_features, eps, momentum)
 
 
+class SpectralNormFP32(SpectralNorm):
+    """Spectral norm with power iteration and sigma kept in float32 under autocast"""
+
+    def compute_weight(self, module, do_power_iteration):
+        with torch.autocast(module.weight_orig.device.type, enabled=False):
+            return super(SpectralNormFP32, self).compute_weight(module, do_power_iteration)
+
+
 def spectral_norm(module):
-    return nn.utils.spectral_norm(module)
+    module = nn.utils.spectral_norm(module)
+    # the pre-hook runs inside the caller's autocast region, so keep the
+    # W.v products of the normalization out of low precision
+    for hook in module._forward_pre_hooks.values():
+        if isinstance(hook, SpectralNorm):
+            hook.__class__ = SpectralNormFP32
+    return module
+
+
+def fuse_conv_bn(conv, bn):
+    """Fold eval batch norm statistics into the preceding (de)conv (without spectral norm)"""
+    return fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose2d))
+
+
+def fuse_bn(network):
+    """Eval copy of network with every (de)conv -> batch norm pair folded"""
+    network = copy.deepcopy(network).eval()
+    for module in list(network.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(1, len(module)):
+            if isinstance(module[i], nn.BatchNorm2d) and \
+                    isinstance(module[i-1], (nn.Conv2d, nn.ConvTranspose2d)):
+                if hasattr(module[i-1], "weight_orig"):
+                    # bake the spectral normalized weight in before folding
+                    nn.utils.remove_spectral_norm(module[i-1])
+                module[i-1] = fuse_conv_bn(module[i-1], module[i])
+                module[i] = nn.Identity()
+    return network
 
 
 ##################################################################################
@@ -66,8 +106,11 @@ class SelfAttn(nn.Module):
         self.v = conv1x1(channels//2, channels)  # [b, c//2, w, h]
         self.gamma = nn.Parameter(torch.zeros(1))  # y = γo + x
 
-        # softmax for matmul of f(x) & g(x)
-        self.softmax = nn.Softmax(dim=-1)
+    def _qkv_weight(self):
+        """f, g and h 1x1 conv weights stacked into a single projection"""
+        weight = torch.cat([self.f.weight, self.g.weight, self.h.weight])
+        bias = torch.cat([self.f.bias, self.g.bias, self.h.bias])
+        return weight.flatten(1), bias
 
     def forward(self, x):
         """
@@ -76,23 +119,24 @@ class SelfAttn(nn.Module):
 
             outputs:
                 out: self attention feature maps (o)
-                attention: attention map (b*n*n)
         """
         b, c, width, height = x.size()
-        N = width*height
-        f = self.f(x).view(b, -1, N).permute(0, 2, 1)  # b*c*n -> b*n*c
-        g = self.g(x).view(b, -1, N)  # b*c*n
-        h = self.h(x).view(b, -1, N)  # b*c*n
+        k = self.f.out_channels
+
+        # f(x), g(x) and h(x) in one matmul, reading x once
+        weight, bias = self._qkv_weight()
+        fgh = F.linear(x.flatten(2).transpose(1, 2), weight, bias)  # b*n*(k+k+c//2)
+        f, g, h = fgh.unsqueeze(1).split([k, k, c//2], dim=-1)  # queries, keys, values
 
-        # f (b x n x c) tensor, g (b x c x n) tensor
-        # out tensor (b x n x n)
-        transpose = torch.bmm(f, g)  # matmul
-        beta = self.softmax(transpose).permute(0, 2, 1)  # b*n*n
+        # fused softmax(f g^T) h, the (n x n) attention map stays on-chip
+        # and is never written out, unscaled as in the paper
+        out = F.scaled_dot_product_attention(f, g, h, scale=1.0)  # b*1*n*c//2
 
-        out = torch.bmm(h, beta)
-        out = self.v(out.view(b, c//2, width, height))
+        # v(o) as a matmul on the flat attention output
+        out = F.linear(out.squeeze(1), self.v.weight.flatten(1), self.v.bias)  # b*n*c
+        out = out.transpose(1, 2).view(b, c, width, height)
 
-        out = self.gamma*out + x
+        out = torch.addcmul(x, self.gamma, out)  # γo + x in one pass
         return out
 
 
@@ -101,13 +145,13 @@ class SelfAttn(nn.Module):
 ##################################################################################
 def loss_hinge_dis_real(d_real):
     """Hinge loss for discriminator with real outputs"""
-    d_loss_real = torch.mean(F.relu(1.0 - d_real))
+    d_loss_real = torch.mean(F.relu(1.0 - d_real, inplace=True))
     return d_loss_real
 
 
 def loss_hinge_dis_fake(d_fake):
     """Hinge loss for discriminator with fake outputs"""
-    d_loss_fake = torch.mean(F.relu(1.0 + d_fake))
+    d_loss_fake = torch.mean(F.relu(1.0 + d_fake, inplace=True))
     return d_loss_fake
 
 
@@ -120,29 +164,11 @@ def loss_hinge_gen(d_fake):
 ##################################################################################
 # Utilities
 ##################################################################################
-def parameters(network):
+def num_parameters(network):
     """Parameters in model"""
-    params = list(p.numel() for p in network.parameters())
-    return sum(params)
-
-
-def tensor2var(x, grad=False):
-    """Tensor to Variable"""
-    if torch.cuda.is_available():
-        x = x.cuda()
-    return torch.autograd.Variable(x, requires_grad=grad)
-
-
-def var2tensor(x):
-    """Variable to Tensor"""
-    return x.data.cpu()
-
-
-def var2numpy(x):
-    return x.data.cpu().numpy()
+    return sum(p.numel() for p in network.parameters())
 
 
 def denorm(x):
-    """Denormalize Images"""
-    out = (x + 1) / 2
-    return out.clamp_(0, 1)
+    """Denormalize Images (in place)"""
+    return x.add_(1).mul_(0.5).clamp_(0, 1)
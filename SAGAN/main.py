@@ -30,7 +30,8 @@ def main(configs):
 
     dataloader = torch.utils.data.DataLoader(
         dataset, batch_size=configs.batch_size,
-        shuffle=True, num_workers=configs.num_workers)
+        shuffle=True, num_workers=configs.num_workers, drop_last=True,
+        pin_memory=True)
 
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     print("Using device : ", device)
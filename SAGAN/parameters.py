@@ -34,6 +34,9 @@ def get_parameters():
     # beta hyperparams for optimizers
     parser.add_argument('--beta1', type=float, default=0.0)
     parser.add_argument('--beta2', type=float, default=0.9)
+    # mixed precision dtype for G and D (float16 uses loss scaling)
+    parser.add_argument('--amp_dtype', type=str, default='bfloat16',
+                        choices=['bfloat16', 'float16'])
 
     parser.add_argument('--train', type=bool, default=False)
     parser.add_argument('--plot', type=bool, default=False)
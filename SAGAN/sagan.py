@@ -3,9 +3,9 @@ import time
 import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-from statistics import mean
 
 import torch
+import torch._inductor.config
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
@@ -24,6 +24,9 @@ class SAGAN():
         # Data Loader
         self.dataloader = dataloader
 
+        # device
+        self.device = torch.device('cuda')
+
         # model settings & hyperparams
         self.total_steps = configs.total_steps
         self.d_iters = configs.d_iters
@@ -37,6 +40,7 @@ class SAGAN():
         self.d_lr = configs.d_lr
         self.beta1 = configs.beta1
         self.beta2 = configs.beta2
+        self.amp_dtype = getattr(torch, configs.amp_dtype)
 
         # instance noise
         self.inst_noise_sigma = configs.inst_noise_sigma
@@ -69,22 +73,52 @@ class SAGAN():
             self.load_pretrained()
 
     def build_model(self):
+        # let cuDNN autotune conv algorithms for the fixed input shapes and
+        # run float32 matmuls and convs on tensor cores (TF32)
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
         # initialize Generator and Discriminator
-        self.G = Generator(self.imsize, self.nz, self.ngf).cuda()
-        self.D = Discriminator(self.ndf).cuda()
+        self.G = Generator(self.imsize, self.nz, self.ngf).to(self.device)
+        self.D = Discriminator(self.ndf).to(self.device)
+
+        # channels last (NHWC) layout for the fast cuDNN conv & batch norm kernels
+        self.G = self.G.to(memory_format=torch.channels_last)
+        self.D = self.D.to(memory_format=torch.channels_last)
+
+        # compiled G and D for the training loop, batch shapes are static so
+        # inductor can fuse kernels and replay each step as a CUDA graph
+        torch._inductor.config.coordinate_descent_tuning = True
+        self.G_compiled = torch.compile(
+            self.G, dynamic=False, mode="reduce-overhead")
+        self.D_compiled = torch.compile(
+            self.D, dynamic=False, mode="reduce-overhead")
+
+        # latent vector and instance noise buffers, refilled in place every iteration
+        self.z_buf = torch.empty(self.batch_size, self.nz, device=self.device)
+        self.inst_noise = torch.empty(
+            self.batch_size, 3, self.imsize, self.imsize, device=self.device,
+            memory_format=torch.channels_last)
 
         # optimizers
-        self.g_optimizer = optim.Adam(filter(
-            lambda p: p.requires_grad, self.G.parameters()), self.g_lr, [self.beta1, self.beta2])
-        self.d_optimizer = optim.Adam(filter(
-            lambda p: p.requires_grad, self.D.parameters()), self.d_lr, [self.beta1, self.beta2])
+        self.g_optimizer = optim.Adam(list(filter(
+            lambda p: p.requires_grad, self.G.parameters())), self.g_lr, [self.beta1, self.beta2], fused=True)
+        self.d_optimizer = optim.Adam(list(filter(
+            lambda p: p.requires_grad, self.D.parameters())), self.d_lr, [self.beta1, self.beta2], fused=True)
+
+        # gradient scalers, only active for float16 mixed precision
+        self.g_scaler = torch.amp.GradScaler(
+            'cuda', enabled=self.amp_dtype == torch.float16)
+        self.d_scaler = torch.amp.GradScaler(
+            'cuda', enabled=self.amp_dtype == torch.float16)
 
         # tensorboard writer
         self.tb = SummaryWriter()
 
-        print("Generator Parameters: ", parameters(self.G))
+        print("Generator Parameters: ", num_parameters(self.G))
         print(self.G)
-        print("Discriminator Parameters: ", parameters(self.D))
+        print("Discriminator Parameters: ", num_parameters(self.D))
         print(self.D)
 
     def load_pretrained(self):
@@ -100,6 +134,23 @@ class SAGAN():
         self.g_optimizer.load_state_dict(checkpoint["gen_optimizer"])
         self.d_optimizer.load_state_dict(checkpoint["disc_optimizer"])
 
+        # checkpoints saved before fused Adam have no "fused" flag, which
+        # load_state_dict would leave unset; re-enable it with the step
+        # counters on the param device as fused Adam expects
+        for optimizer in (self.g_optimizer, self.d_optimizer):
+            for group in optimizer.param_groups:
+                group["fused"] = True
+            for p, state in optimizer.state.items():
+                if "step" in state:
+                    state["step"] = torch.as_tensor(
+                        state["step"], dtype=torch.float32, device=p.device)
+
+        # load gradient scalers (absent from checkpoints saved before mixed precision)
+        if "gen_scaler" in checkpoint:
+            self.g_scaler.load_state_dict(checkpoint["gen_scaler"])
+        if "disc_scaler" in checkpoint:
+            self.d_scaler.load_state_dict(checkpoint["disc_scaler"])
+
         # load losses
         self.ave_d_losses = checkpoint["ave_d_losses"]
         self.ave_d_losses_real = checkpoint["ave_d_losses_real"]
@@ -114,17 +165,29 @@ class SAGAN():
         print("Loading pretrained models (epoch: {})..!".format(
             self.pretrained_model))
 
+    def add_inst_noise(self, images, sigma):
+        """Add instance noise with std sigma, refilling the noise buffer in place"""
+        if sigma == 0:
+            return images
+        inst_noise = self.inst_noise[:images.size(0)].normal_(0.0, sigma)
+        return images + inst_noise
+
     def reset_grad(self):
         """Reset gradients"""
-        self.g_optimizer.zero_grad()
-        self.d_optimizer.zero_grad()
+        self.g_optimizer.zero_grad(set_to_none=True)
+        self.d_optimizer.zero_grad(set_to_none=True)
 
     def train(self):
         step_per_epoch = len(self.dataloader)
         epochs = int(self.total_steps / step_per_epoch)
 
+        # every epoch needs at least one log step to average over
+        if self.log_step > step_per_epoch:
+            raise ValueError("log_step ({}) is larger than the steps per epoch ({})".
+                             format(self.log_step, step_per_epoch))
+
         # fixed z for sampling generator images
-        fixed_z = tensor2var(torch.randn(self.batch_size, self.nz))
+        fixed_z = torch.randn(self.batch_size, self.nz, device=self.device)
 
         print("Initiating Training")
         print("Epochs: {}, Total Steps: {}, Steps/Epoch: {}".
@@ -139,36 +202,27 @@ class SAGAN():
         self.D.train()
         self.G.train()
 
+        # local losses and gammas of each log step in an epoch, kept on the GPU
+        # [d_loss, d_loss_real, d_loss_fake, d_gamma1, d_gamma2, g_loss, g_gamma1, g_gamma2]
+        epoch_logs = torch.empty(
+            step_per_epoch // self.log_step, 8, device=self.device)
+
         # total time
         start_time = time.time()
         for epoch in range(start_epoch, epochs):
-            # local losses
-            d_losses = []
-            d_losses_real = []
-            d_losses_fake = []
-            d_gamma1 = []
-            d_gamma2 = []
-
-            g_losses = []
-            g_gamma1 = []
-            g_gamma2 = []
-
             data_iter = iter(self.dataloader)
             for step in range(step_per_epoch):
+                # new training iteration for the CUDA graphs
+                torch.compiler.cudagraph_mark_step_begin()
+
                 # get real images
                 real_images, _ = next(data_iter)
-                real_images = tensor2var(real_images)
-
-                # Instance noise - make random noise mean (0) and std for injecting
-                inst_noise_mean = torch.full(
-                    (real_images.size(0), 3, self.imsize, self.imsize), 0).cuda()
-                inst_noise_std = torch.full(
-                    (real_images.size(0), 3, self.imsize, self.imsize), self.inst_noise_sigma).cuda()
+                real_images = real_images.to(
+                    self.device, non_blocking=True, memory_format=torch.channels_last)
 
                 # Instance noise std is linearly annealed from self.inst_noise_sigma to 0 thru self.inst_noise_sigma_iters
                 inst_noise_sigma_curr = 0 if step > self.inst_noise_sigma_iters else (
                     1 - step/self.inst_noise_sigma_iters)*self.inst_noise_sigma
-                inst_noise_std.fill_(inst_noise_sigma_curr)
 
                 # ================== TRAIN DISCRIMINATOR ================== #
 
@@ -176,34 +230,35 @@ class SAGAN():
                     self.reset_grad()
 
                     # TRAIN REAL
-                    # creating instance noise
-                    inst_noise = torch.normal(
-                        mean=inst_noise_mean, std=inst_noise_std).cuda()
                     # get D output for real images + noise
-                    d_real = self.D(real_images + inst_noise)
+                    with torch.autocast('cuda', dtype=self.amp_dtype):
+                        d_real = self.D_compiled(self.add_inst_noise(
+                            real_images, inst_noise_sigma_curr))
                     # compute hinge loss of D with real images
-                    d_loss_real = loss_hinge_dis_real(d_real)
-                    d_loss_real.backward()
+                    d_loss_real = loss_hinge_dis_real(d_real.float())
 
                     # TRAIN FAKE
                     # generate fake images and get D output for fake images
-                    z = tensor2var(torch.randn(real_images.size(0), self.nz))
-                    fake_images = self.G(z)
-
-                    # creating instance noise
-                    inst_noise = torch.normal(
-                        mean=inst_noise_mean, std=inst_noise_std).cuda()
-                    # adding noise to fake images
-                    # get D output for fake images
-                    d_fake = self.D(fake_images + inst_noise)
+                    z = self.z_buf[:real_images.size(0)].normal_()
+
+                    with torch.autocast('cuda', dtype=self.amp_dtype):
+                        # G is not updated here, skip building its graph
+                        with torch.no_grad():
+                            fake_images = self.G_compiled(z)
+                        # adding noise to fake images
+                        # get D output for fake images
+                        d_fake = self.D_compiled(self.add_inst_noise(
+                            fake_images, inst_noise_sigma_curr))
                     # compute hinge loss of D with fake images
-                    d_loss_fake = loss_hinge_dis_fake(d_fake)
-                    d_loss_fake.backward()
+                    d_loss_fake = loss_hinge_dis_fake(d_fake.float())
 
+                    # single backward pass through D for real and fake
                     d_loss = d_loss_real + d_loss_fake
+                    self.d_scaler.scale(d_loss).backward()
 
                 # optimize D
-                self.d_optimizer.step()
+                self.d_scaler.step(self.d_optimizer)
+                self.d_scaler.update()
 
                 # ================== TRAIN GENERATOR ================== #
 
@@ -211,32 +266,32 @@ class SAGAN():
                     self.reset_grad()
 
                     # create new latent vector
-                    z = tensor2var(torch.randn(real_images.size(0), self.nz))
+                    z = self.z_buf[:real_images.size(0)].normal_()
 
-                    inst_noise = torch.normal(
-                        mean=inst_noise_mean, std=inst_noise_std).cuda()
-                    # generate fake images
-                    fake_images = self.G(z)
-                    g_fake = self.D(fake_images + inst_noise)
+                    with torch.autocast('cuda', dtype=self.amp_dtype):
+                        # generate fake images
+                        fake_images = self.G_compiled(z)
+                        g_fake = self.D_compiled(self.add_inst_noise(
+                            fake_images, inst_noise_sigma_curr))
 
                     # compute hinge loss for G
-                    g_loss = loss_hinge_gen(g_fake)
-                    g_loss.backward()
+                    g_loss = loss_hinge_gen(g_fake.float())
+                    self.g_scaler.scale(g_loss).backward()
 
-                self.g_optimizer.step()
+                self.g_scaler.step(self.g_optimizer)
+                self.g_scaler.update()
 
                 # logging step progression
                 if (step+1) % self.log_step == 0:
                     # logging losses and attention
-                    d_losses.append(d_loss.item())
-                    d_losses_real.append(d_loss_real.item())
-                    d_losses_fake.append(d_loss_fake.item())
-                    d_gamma1.append(self.D.attn1.gamma.data.item())
-                    d_gamma2.append(self.D.attn2.gamma.data.item())
-
-                    g_losses.append(g_loss.item())
-                    g_gamma1.append(self.G.attn1.gamma.data.item())
-                    g_gamma2.append(self.G.attn2.gamma.data.item())
+                    log = epoch_logs[(step+1) // self.log_step - 1]
+                    log.copy_(torch.stack([
+                        d_loss, d_loss_real, d_loss_fake,
+                        self.D.attn1.gamma.data[0], self.D.attn2.gamma.data[0],
+                        g_loss, self.G.attn1.gamma.data[0], self.G.attn2.gamma.data[0]
+                    ]).detach())
+                    # copied to host in a single sync for the print out
+                    logs = log.tolist()
 
                     # print out
                     elapsed = time.time() - start_time
@@ -244,18 +299,19 @@ class SAGAN():
                     print("Elapsed [{}], Epoch: [{}/{}], Step [{}/{}], g_loss: {:.4f}, d_loss: {:.4f},"
                           " d_loss_real: {:.4f}, d_loss_fake: {:.4f}".
                           format(elapsed, epoch+1, epochs, (step + 1), step_per_epoch,
-                                 g_loss, d_loss, d_loss_real, d_loss_fake))
+                                 logs[5], logs[0], logs[1], logs[2]))
 
-            # logging average losses over epoch
-            self.ave_d_losses.append(mean(d_losses))
-            self.ave_d_losses_real.append(mean(d_losses_real))
-            self.ave_d_losses_fake.append(mean(d_losses_fake))
-            self.ave_d_gamma1.append(mean(d_gamma1))
-            self.ave_d_gamma2.append(mean(d_gamma2))
+            # logging average losses over epoch, reduced on the GPU
+            ave_logs = epoch_logs.mean(dim=0).tolist()
+            self.ave_d_losses.append(ave_logs[0])
+            self.ave_d_losses_real.append(ave_logs[1])
+            self.ave_d_losses_fake.append(ave_logs[2])
+            self.ave_d_gamma1.append(ave_logs[3])
+            self.ave_d_gamma2.append(ave_logs[4])
 
-            self.ave_g_losses.append(mean(g_losses))
-            self.ave_g_gamma1.append(mean(g_gamma1))
-            self.ave_g_gamma2.append(mean(g_gamma2))
+            self.ave_g_losses.append(ave_logs[5])
+            self.ave_g_gamma1.append(ave_logs[6])
+            self.ave_g_gamma2.append(ave_logs[7])
 
             # adding tensorboard logs
             self.tb.add_scalar("d loss", self.ave_d_losses[epoch], epoch)
@@ -277,7 +333,8 @@ class SAGAN():
                          self.ave_g_gamma1[epoch], self.ave_g_gamma2[epoch], self.ave_d_gamma1[epoch], self.ave_d_gamma2[epoch]))
 
             # sample images every epoch
-            fake_images = self.G(fixed_z)
+            with torch.no_grad():
+                fake_images = fuse_bn(self.G)(fixed_z)
             fake_images = denorm(fake_images.data)
             save_image(fake_images,
                        os.path.join(self.sample_path,
@@ -290,6 +347,8 @@ class SAGAN():
                     "disc_state_dict": self.D.state_dict(),
                     "gen_optimizer": self.g_optimizer.state_dict(),
                     "disc_optimizer": self.d_optimizer.state_dict(),
+                    "gen_scaler": self.g_scaler.state_dict(),
+                    "disc_scaler": self.d_scaler.state_dict(),
                     "ave_d_losses": self.ave_d_losses,
                     "ave_d_losses_real": self.ave_d_losses_real,
                     "ave_d_losses_fake": self.ave_d_losses_fake,
@@ -311,15 +370,15 @@ class SAGAN():
         plt.show()
 
     def sample(self, samples):
-        z = tensor2var(torch.randn(samples, self.nz))
-        images = self.G(z)
-        images = denorm(images.data)
+        z = torch.randn(samples, self.nz, device=self.device)
+        with torch.no_grad():
+            images = fuse_bn(self.G)(z)
+        # Unnormalize to [0, 255] and add 0.5 to round to nearest integer,
+        # converting to uint8 on the GPU before the copy to host
+        images = images.add_(1).mul_(127.5).add_(0.5).clamp_(0, 255).to(torch.uint8)
         # https://pytorch.org/docs/stable/_modules/torchvision/utils.html#save_image
-        grid = make_grid(images, nrow=8, padding=2, pad_value=0,
-                         normalize=False, range=None, scale_each=False)
-        # Add 0.5 after unnormalizing to [0, 255] to round to nearest integer
-        ndarr = grid.mul(255).add_(0.5).clamp_(0, 255).permute(
-            1, 2, 0).to('cpu', torch.uint8).numpy()
+        grid = make_grid(images, nrow=8, padding=2, pad_value=0)
+        ndarr = grid.permute(1, 2, 0).contiguous().cpu().numpy()
         im = Image.fromarray(ndarr)
         plt.imshow(im)
         plt.show()